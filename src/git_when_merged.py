@@ -76,73 +76,68 @@ Originally based on:
   http://stackoverflow.com/questions/8475448/find-merge-commit-which-include-a-specific-commit
 """
 
+import os
 import sys
 import re
+import binascii
+import functools
+import shutil
 import subprocess
 import argparse
+import threading
+import concurrent.futures
 
-
-if not (0x02060000 <= sys.hexversion):
-    sys.exit('Python version 2.6 or later is required')
-
-
-# Backwards compatibility:
-try:
-    from subprocess import CalledProcessError
-except ImportError:
-    # Use definition from Python 2.7 subprocess module:
-    class CalledProcessError(Exception):
-        def __init__(self, returncode, cmd, output=None):
-            self.returncode = returncode
-            self.cmd = cmd
-            self.output = output
-        def __str__(self):
-            return "Command '%s' returned non-zero exit status %d" % (self.cmd, self.returncode)
-
-try:
-    from subprocess import check_output
-except ImportError:
-    # Use definition from Python 2.7 subprocess module:
-    def check_output(*popenargs, **kwargs):
-        if 'stdout' in kwargs:
-            raise ValueError('stdout argument not allowed, it will be overridden.')
-        process = subprocess.Popen(stdout=subprocess.PIPE, *popenargs, **kwargs)
-        output, unused_err = process.communicate()
-        retcode = process.poll()
-        if retcode:
-            cmd = kwargs.get("args")
-            if cmd is None:
-                cmd = popenargs[0]
-            try:
-                raise CalledProcessError(retcode, cmd, output=output)
-            except TypeError:
-                # Python 2.6's CalledProcessError has no 'output' kw
-                raise CalledProcessError(retcode, cmd)
-        return output
+from subprocess import CalledProcessError, check_output
 
 
 class Failure(Exception):
     pass
 
 
+_FILESYSTEM_ENCODING = sys.getfilesystemencoding()
+
+
 def _decode_output(value):
     """Decodes Git output into a unicode string.
 
-    On Python 2 this is a no-op; on Python 3 we decode the string as
-    suggested by [1] since we know that Git treats paths as just a sequence
-    of bytes and all of the output we ask Git for is expected to be a file
-    system path.
+    We decode the string as suggested by [1] since we know that Git
+    treats paths as just a sequence of bytes and all of the output we
+    ask Git for is expected to be a file system path.
 
     [1] http://docs.python.org/3/c-api/unicode.html#file-system-encoding
 
     """
-    if sys.hexversion < 0x3000000:
-        return value
-    return value.decode(sys.getfilesystemencoding(), 'surrogateescape')
+    return value.decode(_FILESYSTEM_ENCODING, 'surrogateescape')
+
+
+@functools.lru_cache(maxsize=None)
+def _find_executable(name):
+    return shutil.which(name) or name
+
+
+def spawn_options(cmd):
+    """Return the subprocess keyword arguments for running cmd cheaply.
+
+    Most of the git commands that we run are very quick, so the cost
+    of starting them matters. subprocess can use os.posix_spawn(),
+    which is much faster than fork() + exec(), only if the executable
+    is specified as a path and close_fds is false. Not closing file
+    descriptors is safe, because Python doesn't make them inheritable
+    (see PEP 446).
 
+    This only applies on POSIX systems. On Windows, close_fds=False
+    would stop subprocess from restricting the inherited handles, and
+    the path found for "git" might be a wrapper script that
+    CreateProcess() can't run, so the defaults are used there."""
 
-def check_git_output(*popenargs, **kwargs):
-    return _decode_output(check_output(*popenargs, **kwargs))
+    if os.name != 'posix':
+        return {}
+
+    return dict(executable=_find_executable(cmd[0]), close_fds=False)
+
+
+def check_git_output(cmd, **kwargs):
+    return _decode_output(check_output(cmd, **spawn_options(cmd), **kwargs))
 
 
 def read_refpatterns(name):
@@ -164,29 +159,100 @@ def read_refpatterns(name):
     return retval
 
 
-def iter_commit_refs():
-    """Iterate over the names of references that refer to commits.
+_DEFAULT_REGEXP_FLAGS = re.compile('').flags
+_BACKREFERENCE_RE = re.compile(r'\\[1-9]|\(\?P=')
 
-    (This includes references that refer to annotated tags that refer
-    to commits.)"""
 
-    process = subprocess.Popen(
-        [
-            'git', 'for-each-ref',
-            '--format=%(refname) %(objecttype) %(*objecttype)',
-            ],
-        stdout=subprocess.PIPE,
-        )
-    for line in process.stdout:
-        words = _decode_output(line).strip().split()
-        refname = words.pop(0)
-        if words == ['commit'] or words == ['tag', 'commit']:
-            yield refname
+def combine_refpatterns(refpatterns):
+    """Return a list of regexps that match the same refnames as refpatterns.
+
+    Where possible, the patterns are combined into a single regexp, so
+    that each refname only has to be searched once. Patterns with
+    global flags or backreferences are left as they are, because
+    combining them would change their meaning."""
 
+    simple = []
+    special = []
+    for refpattern in refpatterns:
+        if (
+                refpattern.flags != _DEFAULT_REGEXP_FLAGS
+                or _BACKREFERENCE_RE.search(refpattern.pattern)
+                ):
+            special.append(refpattern)
+        else:
+            simple.append(refpattern)
+
+    if len(simple) > 1:
+        try:
+            simple = [
+                re.compile('|'.join(
+                    '(?:%s)' % (refpattern.pattern,)
+                    for refpattern in simple
+                    ))
+                ]
+        except re.error:
+            pass
+
+    return simple + special
+
+
+# The literal, whole-component prefix of an anchored refpattern. The
+# last "/" must not be followed by a quantifier, which would make it
+# optional:
+_REFPATTERN_PREFIX_RE = re.compile(r'^\^(refs/(?:[A-Za-z0-9_-]+/)*)(?![*?+{])')
+
+
+def refpattern_prefixes(refpatterns):
+    """Return the refname prefixes that refpatterns are limited to.
+
+    If every pattern is anchored to a literal prefix like
+    "^refs/tags/", return the list of those prefixes, which can be
+    passed to "git for-each-ref" to skip other references altogether.
+    Otherwise, return None."""
+
+    prefixes = []
+    for refpattern in refpatterns:
+        # An alternation might not be covered by the anchor, and a
+        # comment could hide a quantifier from _REFPATTERN_PREFIX_RE:
+        if '|' in refpattern.pattern or '(?#' in refpattern.pattern:
+            return None
+        m = _REFPATTERN_PREFIX_RE.match(refpattern.pattern)
+        if not m:
+            return None
+        prefixes.append(m.group(1))
+    return prefixes
+
+
+# A "git for-each-ref" format that outputs the names of references that
+# refer to commits (directly or via an annotated tag), and empty lines
+# for anything else:
+COMMIT_REFS_FORMAT = (
+    '%(if:equals=commit)%(objecttype)%(then)%(refname)'
+    '%(else)%(if:equals=commit)%(*objecttype)%(then)%(refname)%(end)'
+    '%(end)'
+    )
+
+
+def iter_commit_refs(*prefixes):
+    """Iterate over the names of references that refer to commits.
+
+    (This includes references that refer to annotated tags that refer
+    to commits.) If prefixes are specified, only consider references
+    whose names start with one of them."""
+
+    cmd = [
+        'git', 'for-each-ref', '--format=%s' % (COMMIT_REFS_FORMAT,),
+        ] + list(prefixes)
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, **spawn_options(cmd))
+    out = process.stdout.read()
     retcode = process.wait()
     if retcode:
         raise Failure('git for-each-ref failed')
 
+    for refname in out.split(b'\n'):
+        if refname:
+            yield _decode_output(refname)
+
 
 def matches_any(refname, refpatterns):
     return any(
@@ -195,7 +261,95 @@ def matches_any(refname, refpatterns):
         )
 
 
+def refpattern_searcher(refpatterns):
+    """Return a function that tells whether a refname matches refpatterns.
+
+    Normally refpatterns can be combined into a single regexp, and its
+    search() method is returned, so that each refname costs only one
+    call into the regexp engine."""
+
+    refpatterns = combine_refpatterns(refpatterns)
+    if len(refpatterns) == 1:
+        return refpatterns[0].search
+    else:
+        return lambda refname: matches_any(refname, refpatterns)
+
+
+class CatFileBatch:
+    """A long-running "git cat-file --batch-check" for looking up objects.
+
+    The process is started the first time it is needed, and can be
+    used from multiple threads."""
+
+    FORMAT = '%(objectname) %(objecttype)'
+
+    def __init__(self):
+        self.process = None
+        self.lock = threading.Lock()
+
+    def lookup(self, name):
+        """Return (sha1, objecttype) for object name, or None.
+
+        None is returned if name does not exist or is ambiguous, or if
+        git gave up on it altogether. name can be anything that git
+        understands as an object name, like "master^{commit}", but it
+        must not contain a newline."""
+
+        with self.lock:
+            if self.process is None:
+                cmd = ['git', 'cat-file', '--batch-check=%s' % (self.FORMAT,)]
+                self.process = subprocess.Popen(
+                    cmd,
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                    **spawn_options(cmd)
+                    )
+            self.process.stdin.write(
+                name.encode(_FILESYSTEM_ENCODING, 'surrogateescape') + b'\n'
+                )
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+
+            if not line:
+                # Some names (like "HEAD@{1000}") make "git cat-file"
+                # die rather than report them as missing. Start a new
+                # process next time:
+                self.process.stdout.close()
+                self.process.stdin.close()
+                self.process.wait()
+                self.process = None
+                return None
+
+        # For objects that cannot be found, the output is "NAME missing"
+        # or "NAME ambiguous", and NAME might contain spaces:
+        (sha1, _, objecttype) = line.rstrip(b'\n').rpartition(b' ')
+        if objecttype in (b'missing', b'ambiguous') or b' ' in sha1:
+            return None
+        return (sha1.decode('ascii'), objecttype.decode('ascii'))
+
+    def close(self):
+        with self.lock:
+            if self.process is not None:
+                self.process.stdin.close()
+                self.process.wait()
+                self.process = None
+
+
+_cat_file = CatFileBatch()
+
+
+@functools.lru_cache(maxsize=4096)
 def rev_parse(arg, abbrev=None):
+    if not abbrev and '\n' not in arg and '@{' not in arg:
+        # This is the usual case, and it doesn't need a new process.
+        # (Reflog and upstream names are left to "git rev-parse", which
+        # explains what is wrong with them.)
+        result = _cat_file.lookup(arg)
+        if result is None:
+            raise Failure('%r is not a valid commit!' % (arg,))
+        return result[0]
+
+    # "git cat-file" cannot abbreviate SHA-1s:
     if abbrev:
         cmd = ['git', 'rev-parse', '--verify', '-q', '--short=%d' % (abbrev,), arg]
     else:
@@ -207,13 +361,16 @@ def rev_parse(arg, abbrev=None):
         raise Failure('%r is not a valid commit!' % (arg,))
 
 
+@functools.lru_cache(maxsize=4096)
 def describe(arg, contains=False):
     cmd = ['git', 'describe']
     if contains:
         cmd += ['--contains']
     cmd += [arg]
 
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    process = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **spawn_options(cmd)
+        )
     out, err = process.communicate()
     retcode = process.poll()
     if retcode:
@@ -223,65 +380,193 @@ def describe(arg, contains=False):
 
 
 def rev_list(*args):
-    """Iterate over (commit, [parent,...]) for the selected commits.
+    """Return a list of the SHA-1s of the selected commits.
 
     args are passed as arguments to "git rev-list" to select which
-    commits should be iterated over.
+    commits should be listed. The SHA-1s are returned as ASCII bytes.
 
     """
 
-    process = subprocess.Popen(
-        ['git', 'rev-list'] + list(args) + ['--'],
-        stdout=subprocess.PIPE,
-        )
-    for line in process.stdout:
-        yield _decode_output(line).strip()
-
+    cmd = ['git', 'rev-list'] + list(args) + ['--']
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, **spawn_options(cmd))
+    out = process.stdout.read()
     retcode = process.wait()
     if retcode:
         raise Failure('git rev-list %s failed' % (' '.join(args),))
 
+    return out.splitlines()
+
+
+def is_ancestor(commit1, commit2):
+    """Return True iff commit1 is an ancestor of (or the same as) commit2."""
+
+    cmd = ['git', 'merge-base', '--is-ancestor', commit1, commit2]
+    retcode = subprocess.call(cmd, **spawn_options(cmd))
+    if retcode == 0:
+        return True
+    elif retcode == 1:
+        return False
+    else:
+        raise Failure('command "%s" failed' % (' '.join(cmd),))
+
+
+def _parse_commit_record(record):
+    """Parse a "%H %P" record into (commit, (parent,...))."""
+
+    (sha1, _, parents) = record.partition(b' ')
+    return (sha1, tuple(parents.split(b' ')) if parents else ())
+
+
+def iter_records(f, size=65536):
+    """Iterate over the NUL-terminated records read from file f.
+
+    Read in chunks of whatever is available (up to size bytes), so
+    that records can be processed while git is still producing more."""
+
+    pending = b''
+    while True:
+        data = f.read1(size)
+        if not data:
+            break
+        records = (pending + data).split(b'\0')
+        pending = records.pop()
+        for record in records:
+            yield record
+    if pending:
+        yield pending
+
 
 def rev_list_with_parents(*args):
-    cmd = ['git', 'log', '--format=%H %P'] + list(args) + ['--']
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    for line in process.stdout:
-        words = _decode_output(line).strip().split()
-        yield (words[0], words[1:])
+    """Iterate over (commit, (parent,...)) for the selected commits.
+
+    args are passed as arguments to "git log" to select which commits
+    should be iterated over. The SHA-1s are returned as ASCII bytes.
+
+    """
 
+    cmd = ['git', 'log', '-z', '--format=%H %P'] + list(args) + ['--']
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, **spawn_options(cmd))
+    data = process.stdout.read()
     retcode = process.wait()
     if retcode:
         raise Failure('command "%s" failed' % (' '.join(cmd),))
 
+    for record in data.split(b'\0'):
+        if record:
+            yield _parse_commit_record(record)
+
 
 class CommitGraph:
+    """The parents of the commits selected by "git log" args.
+
+    The output of "git log" is read lazily, only as far as needed to
+    answer each lookup. Commits are identified by their binary object
+    names (e.g., 20 bytes for SHA-1). The parents of all commits are
+    stored back to back in a single bytearray; for each commit,
+    self.commits records the offset of its first parent in that array
+    and its number of parents.
+
+    """
+
     def __init__(self, *args):
-        self.commits = dict(rev_list_with_parents(*args))
+        self.cmd = ['git', 'log', '-z', '--format=%H %P'] + list(args) + ['--']
+        self.process = subprocess.Popen(
+            self.cmd, stdout=subprocess.PIPE, **spawn_options(self.cmd)
+            )
+        self.records = iter_records(self.process.stdout)
+        self.commits = {}
+        self.parents = bytearray()
+        self.oid_size = None
+
+    def _read_until(self, commit):
+        """Read commits from "git log" until commit has been read.
+
+        Return the (offset, nparents) entry for commit, or None if the
+        output ends without commit having been seen."""
+
+        if self.process is None:
+            return None
+
+        commits = self.commits
+        parents = self.parents
+        for record in self.records:
+            if self.oid_size is None:
+                self.oid_size = len(record.split(b' ', 1)[0]) // 2
+            size = self.oid_size
+
+            # This converts the commit and all of its parents at once:
+            oids = binascii.unhexlify(record.replace(b' ', b''))
+            sha1 = oids[:size]
+            entry = commits[sha1] = (len(parents), len(oids) // size - 1)
+            parents += oids[size:]
+            if sha1 == commit:
+                return entry
+
+        self._finish()
+        return None
+
+    def _finish(self):
+        self.process.stdout.close()
+        retcode = self.process.wait()
+        self.process = None
+        if retcode:
+            raise Failure('command "%s" failed' % (' '.join(self.cmd),))
+
+    def close(self):
+        """Stop reading from "git log", even if there is more output."""
+
+        if self.process is not None:
+            self.process.stdout.close()
+            self.process.wait()
+            self.process = None
+
+    def _entry(self, commit):
+        entry = self.commits.get(commit)
+        if entry is None:
+            entry = self._read_until(commit)
+        return entry
 
     def __contains__(self, commit):
-        return commit in self.commits
+        return self._entry(commit) is not None
 
     def __getitem__(self, commit):
-        return self.commits[commit]
+        entry = self._entry(commit)
+        if entry is None:
+            raise KeyError(commit)
+        (offset, nparents) = entry
+        size = self.oid_size
+        return tuple(
+            bytes(self.parents[i:i + size])
+            for i in range(offset, offset + nparents * size, size)
+            )
 
     def first_parent_path(self, commit):
         """Iterate over the commits in the first-parent ancestry of commit.
 
         Iterate over the commits that are within this CommitGraph that
         are also in the first-parent ancestry of the specified commit.
-        commit must be a full 40-character SHA-1.
+        commit must be a full binary object name.
 
         """
 
+        # This loop can run for many thousands of steps, so keep it
+        # tight. Usually commit has already been read, so try the dict
+        # directly before falling back to reading more of the output:
+        get = self.commits.get
+        parents = self.parents
+        size = self.oid_size
         while True:
-            try:
-                parents = self[commit]
-            except KeyError:
-                return
+            entry = get(commit)
+            if entry is None:
+                entry = self._read_until(commit)
+                if entry is None:
+                    return
+                size = self.oid_size
             yield commit
-            if not parents:
+            (offset, nparents) = entry
+            if not nparents:
                 return
-            commit = parents[0]
+            commit = bytes(parents[offset:offset + size])
 
 
 class MergeNotFoundError(Exception):
@@ -307,11 +592,217 @@ class MergedViaMultipleParentsError(MergeNotFoundError):
         self.msg = 'Merged via multiple parents: %s' % (' '.join(parents),)
 
 
-def find_merge(commit_sha1, branch):
+def _find_direct_merge(commit_sha1, spine):
+    """Find the commit in spine that merged commit_sha1 directly.
+
+    spine is the list of (commit, (parent,...)) on the first-parent
+    history of a branch, limited to commits that are not ancestors of
+    commit_sha1, newest first, as bytes. Return the (merge, parents)
+    that we are looking for if one of the entries has commit_sha1 as a
+    parent, or None if commit_sha1 was merged in indirectly (or more
+    than once)."""
+
+    commit = commit_sha1.encode('ascii')
+    merge = None
+    for (sha1, parents) in spine:
+        if commit in parents:
+            (merge, merge_parents) = (sha1, parents)
+            first_parent_in_range = False
+        elif merge is not None:
+            first_parent_in_range = True
+
+    # The merge is the one we are looking for unless its first parent
+    # also contains commit. (If the first parent is not in the range
+    # then it is an ancestor of commit, so it doesn't.)
+    if merge is not None and (
+            merge_parents[0] == commit
+            or not first_parent_in_range
+            or not is_ancestor(commit_sha1, merge_parents[0].decode('ascii'))
+            ):
+        return (merge, merge_parents)
+    else:
+        return None
+
+
+def _decode_step(merge, parents, via):
+    return (
+        merge.decode('ascii'),
+        tuple(parent.decode('ascii') for parent in parents),
+        tuple(parent.decode('ascii') for parent in via),
+        )
+
+
+def _find_direct_step(commit_sha1, branch_sha1):
+    """Try to do a step of find_merge() without a CommitGraph.
+
+    Return (step, spine). step is (merge, parents, via) like
+    _merge_commit_for() if branch_sha1 does not contain commit_sha1,
+    or if commit_sha1 was merged into it directly; otherwise it is
+    None, and spine is the first-parent history that was read, as
+    described for _find_direct_merge()."""
+
+    # Listing the first-parent history is wasted effort if branch_sha1
+    # doesn't contain commit_sha1 at all, so check that first:
+    if not is_ancestor(commit_sha1, branch_sha1):
+        return ((None, (), ()), None)
+
+    # Usually commit was merged directly into branch, in which case it
+    # is a parent of one of the commits on the first-parent history of
+    # branch. Those commits are cheap to list, so try that first:
+    spine = list(rev_list_with_parents(
+        '--first-parent', '%s..%s' % (commit_sha1, branch_sha1),
+        ))
+    direct = _find_direct_merge(commit_sha1, spine)
+    if direct is not None:
+        (merge, parents) = direct
+        return (_decode_step(merge, parents, ()), spine)
+
+    return (None, spine)
+
+
+@functools.lru_cache(maxsize=None)
+def _find_merge_fast(commit_sha1, branch_sha1):
+    """Like _merge_commit_for(), but without loading a CommitGraph.
+
+    Only the first-parent history of branch_sha1 (with the parents of
+    those commits) and the bare SHA-1s of the commits on the ancestry
+    path are read; the parents of the commits on side branches are
+    never loaded. That is all that is needed to find the first merge,
+    which is all that a non-recursive search looks at."""
+
+    (step, spine) = _find_direct_step(commit_sha1, branch_sha1)
+    if step is not None:
+        return step
+
+    ancestry_path = set(rev_list(
+        '--ancestry-path', '%s..%s' % (commit_sha1, branch_sha1),
+        ))
+
+    # The commits on spine that contain commit_sha1 come first:
+    merge = None
+    for (sha1, parents) in spine:
+        if sha1 not in ancestry_path:
+            break
+        (merge, merge_parents) = (sha1, parents)
+
+    if merge is None:
+        return (None, (), ())
+
+    if commit_sha1.encode('ascii') in merge_parents:
+        via = ()
+    else:
+        via = tuple(
+            parent
+            for parent in merge_parents
+            if parent in ancestry_path
+            )
+        assert(via)
+
+    return _decode_step(merge, merge_parents, via)
+
+
+def _merge_commit_for(commit_sha1, branch_sha1, commit_graph):
+    """Find the commit that merged commit_sha1 into branch_sha1.
+
+    Return (merge, parents, via). merge is the oldest commit on the
+    first-parent history of branch_sha1 that contains commit_sha1, or
+    None if there is no such commit, and parents are its parents. If
+    commit_sha1 is not itself one of the parents, via is the tuple of
+    parents through which it was merged in; otherwise it is empty.
+
+    commit_graph must be the ancestry-path CommitGraph from
+    commit_sha1 to branch_sha1, or to a descendant of branch_sha1.
+    (The latter contains the former.)"""
+
+    # CommitGraph works with binary object names:
+    commit = binascii.unhexlify(commit_sha1)
+    tip = binascii.unhexlify(branch_sha1)
+
+    branch_commits = list(commit_graph.first_parent_path(tip))
+
+    if not branch_commits:
+        return (None, (), ())
+
+    # The last entry in branch_commits is the one that merged in
+    # commit.
+    last = branch_commits[-1]
+    parents = commit_graph[last]
+
+    if commit in parents:
+        via = ()
+    else:
+        # Find which parent(s) merged in the commit:
+        via = tuple(
+            parent
+            for parent in parents
+            if parent in commit_graph
+            )
+        assert(via)
+
+    return _decode_step(
+        binascii.hexlify(last),
+        tuple(binascii.hexlify(parent) for parent in parents),
+        tuple(binascii.hexlify(parent) for parent in via),
+        )
+
+
+# The steps of recursive find_merge() searches, keyed by (commit_sha1,
+# branch_sha1). Different branches often lead to the same merges:
+_merge_steps = {}
+
+
+def _iter_merge_steps(commit_sha1, branch_sha1, recursive=True):
+    """Iterate over the steps of a search for commit_sha1 in branch_sha1.
+
+    Generate (merge, parents, via) like _merge_commit_for() for each
+    merge, following via for as long as it leads to a single parent.
+
+    If recursive is false, generate only the first step, found by
+    _find_merge_fast(). Otherwise, the steps are cached in
+    _merge_steps. A CommitGraph is loaded at most once, for the first
+    step that isn't cached and can't be found more cheaply, and is
+    shared by all of the following steps."""
+
+    if not recursive:
+        yield _find_merge_fast(commit_sha1, branch_sha1)
+        return
+
+    commit_graph = None
+    try:
+        while True:
+            key = (commit_sha1, branch_sha1)
+            step = _merge_steps.get(key)
+            if step is None and commit_graph is None:
+                (step, spine) = _find_direct_step(commit_sha1, branch_sha1)
+                if step is None:
+                    # commit was merged indirectly (or more than
+                    # once), so we need the full ancestry-path graph
+                    # to follow it:
+                    commit_graph = CommitGraph(
+                        '--ancestry-path', '%s..%s' % (commit_sha1, branch_sha1),
+                        )
+            if step is None:
+                step = _merge_commit_for(commit_sha1, branch_sha1, commit_graph)
+            _merge_steps[key] = step
+
+            yield step
+
+            (merge, parents, via) = step
+            if merge is None or commit_sha1 in parents or len(via) != 1:
+                return
+            [branch_sha1] = via
+    finally:
+        if commit_graph is not None:
+            commit_graph.close()
+
+
+def find_merge(commit_sha1, branch, recursive=True):
     """Return the SHA-1 of the commit that merged commit into branch.
 
     It is assumed that content is always merged in via the second or
-    subsequent parents of a merge commit."""
+    subsequent parents of a merge commit. If recursive is false, the
+    caller is only interested in the first merge, which can be found
+    more cheaply."""
 
     try:
         branch_sha1 = rev_parse('%s^{commit}' % (branch,))
@@ -321,41 +812,56 @@ def find_merge(commit_sha1, branch):
     if branch_sha1 == commit_sha1:
         raise DirectlyOnBranchError(branch)
 
-    commit_graph = CommitGraph('--ancestry-path', '%s..%s' % (commit_sha1, branch_sha1))
+    steps = _iter_merge_steps(commit_sha1, branch_sha1, recursive)
+    try:
+        for (merge, parents, via) in steps:
+            if merge is None:
+                raise DoesNotContainCommitError(branch)
 
-    while True:
-        branch_commits = list(commit_graph.first_parent_path(branch_sha1))
+            if parents[0] == commit_sha1:
+                raise DirectlyOnBranchError(branch)
 
-        if not branch_commits:
-            raise DoesNotContainCommitError(branch)
+            yield merge
 
-        # The last entry in branch_commits is the one that merged in
-        # commit.
-        last = branch_commits[-1]
-        parents = commit_graph[last]
+            if commit_sha1 in parents:
+                # The commit was merged in directly:
+                return
 
-        if parents[0] == commit_sha1:
-            raise DirectlyOnBranchError(branch)
+            if len(via) > 1:
+                raise MergedViaMultipleParentsError(branch, via)
+    finally:
+        steps.close()
 
-        yield last
 
-        if commit_sha1 in parents:
-            # The commit was merged in directly:
-            return
+def list_merges(commit_sha1, branch, recursive=True):
+    """Run find_merge() to completion.
 
-        # Find which parent(s) merged in the commit:
-        parents = [
-            parent
-            for parent in parents
-            if parent in commit_graph
-            ]
-        assert(parents)
-        if len(parents) > 1:
-            raise MergedViaMultipleParentsError(branch, parents)
+    Return (merges, error), where merges is the list of SHA-1s that
+    find_merge() generated and error is the MergeNotFoundError or
+    Failure that ended it (or None). This allows find_merge() to be
+    run in a worker thread; see replay_merges()."""
+
+    merges = []
+    try:
+        for sha1 in find_merge(commit_sha1, branch, recursive):
+            merges.append(sha1)
+            if not recursive:
+                break
+    except (MergeNotFoundError, Failure) as e:
+        return (merges, e)
+    return (merges, None)
+
+
+def replay_merges(merges, error):
+    """Iterate over the results of list_merges() like find_merge() would."""
 
-        [branch_sha1] = parents
+    for sha1 in merges:
+        yield sha1
+    if error is not None:
+        raise error
 
 
+@functools.lru_cache(maxsize=4096)
 def get_full_name(branch):
     """Return the full name of the specified commit.
 
@@ -383,6 +889,74 @@ def get_full_name(branch):
     return branch
 
 
+def get_full_names(branches):
+    """Return a dict mapping each of branches to its full name.
+
+    The result is the same as calling get_full_name() for each branch,
+    but a single "git rev-parse" is used to look up all of them.
+    "--symbolic-full-name" emits nothing for arguments that are not
+    references, so "--is-bare-repository" (which always prints "true"
+    or "false") is interleaved to mark where the output for each
+    branch ends. Arguments that git would take for options, and
+    arguments whose output is not a single reference name (e.g.,
+    ranges), are looked up via get_full_name(). If any branch is
+    invalid, all of them are looked up via get_full_name()."""
+
+    full_names = {}
+
+    remaining = []
+    for branch in branches:
+        if not branch or branch.startswith('-'):
+            full_names[branch] = get_full_name(branch)
+        else:
+            remaining.append(branch)
+
+    if not remaining:
+        return full_names
+
+    cmd = ['git', 'rev-parse', '-q', '--symbolic-full-name']
+    for branch in remaining:
+        cmd += [branch, '%s^{commit}' % (branch,), '--is-bare-repository']
+    process = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        **spawn_options(cmd)
+        )
+    out, err = process.communicate()
+    retcode = process.poll()
+
+    outputs = []
+    lines = []
+    for line in _decode_output(out).splitlines():
+        if line in ('true', 'false'):
+            outputs.append(lines)
+            lines = []
+        else:
+            lines.append(line)
+
+    if retcode or len(outputs) != len(remaining):
+        # At least one branch is invalid. When it fails, git echoes
+        # arguments that it took for filenames, so the output cannot be
+        # trusted to tell which one. Let get_full_name() handle them
+        # all, in order, so that it reports the first error:
+        for branch in remaining:
+            full_names[branch] = get_full_name(branch)
+        return full_names
+
+    # Pass on any diagnostics, like "refname 'a' is ambiguous" (as
+    # with get_full_name(), "-q" suppresses the noisier warnings):
+    sys.stderr.write(_decode_output(err))
+
+    for (branch, lines) in zip(remaining, outputs):
+        if not lines:
+            full_names[branch] = branch
+        elif len(lines) == 1 and not lines[0].startswith('^'):
+            full_names[branch] = lines[0]
+        else:
+            full_names[branch] = get_full_name(branch)
+
+    return full_names
+
+
 FIRST_FORMAT = '%(refname)-38s %(name)s'
 OTHER_FORMAT = FIRST_FORMAT % dict(refname='', name='via %(name)s')
 
@@ -393,17 +967,39 @@ WARN_FORMAT = '%(refname)-38s %(msg)s'
 
 
 def name_commit(sha1, options):
-    if options.describe:
+    return _name_commit(
+        sha1, options.describe, options.describe_contains, options.abbrev,
+        )
+
+
+@functools.lru_cache(maxsize=4096)
+def _name_commit(sha1, describe_, describe_contains, abbrev):
+    if describe_:
         return describe(sha1) or sha1
-    elif options.describe_contains:
+    elif describe_contains:
         return describe(sha1, contains=True) or sha1
-    elif options.abbrev is not None:
-        return rev_parse(sha1, abbrev=options.abbrev)
+    elif abbrev is not None:
+        return rev_parse(sha1, abbrev=abbrev)
     else:
         return sha1
 
 
 def main(args=None):
+    try:
+        _main(args)
+    finally:
+        _cat_file.close()
+        # The caches are only valid for a single invocation; the
+        # references might have moved by the time of the next one:
+        for cached in (
+                rev_parse, describe, get_full_name, _name_commit,
+                _find_merge_fast,
+                ):
+            cached.cache_clear()
+        _merge_steps.clear()
+
+
+def _main(args=None):
     if args is None:
         args = sys.argv[1:]
     parser = argparse.ArgumentParser(
@@ -576,25 +1172,72 @@ def main(args=None):
     branches = set()
 
     if refpatterns:
+        prefixes = refpattern_prefixes(refpatterns) or []
+        search = refpattern_searcher(refpatterns)
         branches.update(
             refname
-            for refname in iter_commit_refs()
-            if matches_any(refname, refpatterns)
+            for refname in iter_commit_refs(*prefixes)
+            if search(refname)
             )
 
-    for branch in options.branch:
-        try:
-            branches.add(get_full_name(branch))
-        except Failure as e:
-            sys.exit(str(e))
+    try:
+        branches.update(get_full_names(options.branch).values())
+    except Failure as e:
+        sys.exit(str(e))
 
     if not branches:
         branches.add(get_full_name('HEAD'))
 
-    for branch in sorted(branches):
+    branches = sorted(branches)
+
+    executor = None
+    if (
+            options.show_commit or options.show_branch
+            or options.log or options.diff or options.visualize
+            or len(branches) == 1
+            ):
+        # Handle one branch after the other, interleaved with the
+        # output and the commands that are run for each merge. (With
+        # --show-commit/--show-branch, the first error ends the
+        # program, so the remaining branches shouldn't be looked up.)
+        results = [
+            find_merge(commit_sha1, branch, options.recursive)
+            for branch in branches
+            ]
+    else:
+        # The branches are independent, so look them up in parallel.
+        # The results are still reported in order, below:
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(8, len(branches)),
+            )
+        futures = [
+            executor.submit(list_merges, commit_sha1, branch, options.recursive)
+            for branch in branches
+            ]
+        results = (replay_merges(*future.result()) for future in futures)
+
+    try:
+        _report_merges(
+            commit_sha1, branches, results, options,
+            first_format, other_format, warn,
+            )
+    finally:
+        if executor is not None:
+            # Don't leave workers running (and using _cat_file) after
+            # an early exit:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+
+def _report_merges(
+        commit_sha1, branches, results, options,
+        first_format, other_format, warn,
+        ):
+    for (branch, merges) in zip(branches, results):
         first = True
         try:
-            for sha1 in find_merge(commit_sha1, branch):
+            for sha1 in merges:
                 name = name_commit(sha1, options)
 
                 if first: